@@ -1,8 +1,16 @@
 import streamlit as st
-import pandas as pd
+import asyncio
+import contextlib
+import csv
 import io
+import math
+import random
+import threading
 import time
+import uuid
+from collections import deque
 from google import genai
+from google.genai import types
 from google.genai.errors import APIError
 
 # --- 상수 설정 ---
@@ -12,6 +20,7 @@ MODEL_OPTIONS = [
     'gemini-1.5-flash',
     'gemini-1.5-pro',
 ]
+DEFAULT_MODEL_IDX = 0  # 기본 모델(gemini-2.0-flash)은 목록 맨 앞에 둠
 
 SYSTEM_PROMPT = """당신은 따뜻하고 공감 능력이 뛰어난 전문 심리 상담가입니다.
 
@@ -21,78 +30,212 @@ SYSTEM_PROMPT = """당신은 따뜻하고 공감 능력이 뛰어난 전문 심
 
 답변은 희망과 안정감을 줄 수 있도록, 사용자를 자극하거나 판단하지 않도록 각별히 주의해야 합니다."""
 
+# 시스템 프롬프트는 대화 내용과 분리해 system_instruction으로 전달
+CHAT_CONFIG = types.GenerateContentConfig(system_instruction=SYSTEM_PROMPT)
+
+# 대화 히스토리 역할 ID ((역할 ID, 텍스트) 튜플로 저장)
+USER, MODEL = 0, 1
+ROLE_NAMES = ("user", "model")  # 역할 ID -> st.chat_message 역할명
+AVATARS = {"user": "🙂", "model": "🤖"}
+
+# 재시도 백오프 설정 (초 단위)
+RETRYABLE_STATUS_CODES = (429, 503)
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 10  # API 오류 재시도 1회당 최대 대기 시간 (서버 지정 시간이 더 길면 재시도 중단)
+CONGESTION_ALPHA = 0.3  # 429 발생률 지수이동평균 가중치
+STREAM_CHUNK_TIMEOUT = 60  # 응답 조각 하나를 기다리는 최대 시간
+
+CSV_FIELDS = ['session_id', 'model', 'timestamp', 'role', 'message']
+CSV_LOG_MAXLEN = 20000  # 메모리에 유지할 최대 로그 행 수 (초과 시 오래된 행부터 제거)
+
 # --- Streamlit 상태 초기화 ---
 if 'history' not in st.session_state:
     st.session_state['history'] = []
 if 'session_id' not in st.session_state:
-    st.session_state['session_id'] = f"session_{time.strftime('%Y%m%d%H%M%S')}"
+    st.session_state['session_id'] = f"session_{uuid.uuid4().hex[:12]}"
 if 'csv_log' not in st.session_state:
-    st.session_state['csv_log'] = []
+    st.session_state['csv_log'] = deque(maxlen=CSV_LOG_MAXLEN)
+    st.session_state['csv_log_total'] = 0  # 제거된 행을 포함한 전체 기록 행 수
+if 'contents' not in st.session_state:
+    st.session_state['contents'] = []  # API 전달용 types.Content 누적 목록
+if 'congestion_ema' not in st.session_state:
+    st.session_state['congestion_ema'] = 0.0
 
 # --- 기능 함수 정의 ---
+# 임시 키 입력란으로 들어온 키마다 클라이언트가 쌓이지 않도록 개수·유지 시간 제한
+@st.cache_resource(show_spinner=False, max_entries=4, ttl=3600)
 def initialize_client(api_key):
-    """Gemini 클라이언트 초기화"""
-    try:
-        return genai.Client(api_key=api_key)
-    except Exception as e:
-        st.error(f"클라이언트 초기화 오류: {e}")
-        return None
+    """Gemini 클라이언트 초기화 (API 키별로 한 번만 생성해 모든 세션이 공유)"""
+    return genai.Client(api_key=api_key)
+
+def append_csv_log(rows):
+    """CSV 로그 추가 (대화 내용은 디스크에 쓰지 않고 세션 메모리에만 보관, 상한 초과 시 오래된 행부터 제거)"""
+    st.session_state['csv_log'].extend(rows)
+    st.session_state['csv_log_total'] += len(rows)
+
+def build_csv_log():
+    """다운로드용 CSV 생성"""
+    csv_buffer = io.StringIO()
+    writer = csv.DictWriter(csv_buffer, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    writer.writerows(st.session_state['csv_log'])
+    return csv_buffer.getvalue().encode('utf-8-sig')  # 엑셀 한글 호환 (BOM)
 
 def reset_conversation():
-    """대화 초기화"""
+    """대화 초기화 (버튼 on_click 콜백: 스크립트 재실행 전에 상태를 비움)"""
     st.session_state['history'] = []
-    st.session_state['session_id'] = f"session_{time.strftime('%Y%m%d%H%M%S')}"
-    st.session_state['csv_log'] = []
-    st.rerun()
-
-def call_gemini_api(client, model_name, prompt, max_retries=5):
-    """Gemini API 호출 (429/503 재시도 포함, 최근 6턴 히스토리 유지)"""
-    # 최근 6턴 히스토리 추출 (12개 메시지: user + model 쌍)
-    recent_history = st.session_state['history'][-12:] if len(st.session_state['history']) > 0 else []
-    
-    # 히스토리 컨텍스트 구성
-    history_context = ""
-    for msg in recent_history:
-        if msg['role'] == 'user':
-            history_context += f"사용자: {msg['text']}\n"
-        elif msg['role'] == 'model':
-            history_context += f"상담가: {msg['text']}\n"
-    
-    # 전체 프롬프트 구성 (시스템 프롬프트 + 히스토리 + 현재 메시지)
-    if history_context:
-        full_prompt = f"{SYSTEM_PROMPT}\n\n이전 대화:\n{history_context}\n사용자: {prompt}"
-    else:
-        full_prompt = f"{SYSTEM_PROMPT}\n\n사용자: {prompt}"
+    st.session_state['session_id'] = f"session_{uuid.uuid4().hex[:12]}"
+    st.session_state['csv_log'] = deque(maxlen=CSV_LOG_MAXLEN)
+    st.session_state['csv_log_total'] = 0
+    st.session_state['contents'] = []
+
+def get_chat(client, model_name):
+    """최근 6턴 히스토리로 채팅 객체 생성 (클라이언트 측 객체라 매 턴 생성해도 네트워크 비용 없음)"""
+    # 최근 6턴 히스토리 (12개 메시지: user + model 쌍)
+    return client.aio.chats.create(
+        model=model_name,
+        config=CHAT_CONFIG,
+        history=st.session_state['contents'][-12:],
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    """모든 세션이 공유하는 백그라운드 이벤트 루프 (프로세스당 1개)"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_async(coro, timeout=None):
+    """코루틴을 공유 이벤트 루프에서 실행하고 결과를 기다림 (시간 초과 시 루프에서 취소가 끝난 뒤 asyncio.TimeoutError)"""
+    if timeout is not None:
+        coro = asyncio.wait_for(coro, timeout)
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+def iterate_async(agen, timeout=STREAM_CHUNK_TIMEOUT):
+    """비동기 제너레이터를 스크립트 스레드에서 동기 제너레이터로 변환"""
+    try:
+        while True:
+            try:
+                yield run_async(agen.__anext__(), timeout)
+            except StopAsyncIteration:
+                return
+    finally:
+        run_async(agen.aclose())
+
+async def stream_gemini(chat, message):
+    """Gemini 스트리밍 호출 (텍스트 조각 단위로 반환)"""
+    stream = await chat.send_message_stream(message)
+    # 취소·중단 시에도 스트림(HTTP 응답)을 닫도록 aclosing 사용
+    async with contextlib.aclosing(stream):
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+def get_retry_after(error):
+    """서버가 지정한 재시도 대기 시간(초) 추출 (Retry-After 헤더 또는 RetryInfo)"""
+    candidates = []
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers and headers.get('Retry-After'):
+        candidates.append(headers.get('Retry-After'))
+    details = error.details.get('error', {}).get('details', []) if isinstance(error.details, dict) else []
+    for detail in details:
+        if detail.get('@type', '').endswith('RetryInfo') and 'retryDelay' in detail:
+            candidates.append(str(detail['retryDelay']).rstrip('s'))
+    for value in candidates:
+        try:
+            delay = float(value)
+        except ValueError:
+            continue
+        # 음수·nan·inf는 time.sleep 오류를 일으키므로 무시
+        if math.isfinite(delay) and delay >= 0:
+            return delay
+    return None
+
+def update_congestion(rate_limited):
+    """최근 429/503 발생률의 지수이동평균 갱신"""
+    ema = st.session_state['congestion_ema']
+    st.session_state['congestion_ema'] = CONGESTION_ALPHA * rate_limited + (1 - CONGESTION_ALPHA) * ema
+
+def next_backoff(prev_wait, max_wait):
+    """Decorrelated jitter 백오프 (혼잡도가 높을수록 기준 대기 시간 증가)"""
+    base = RETRY_BASE_DELAY * (1 + 4 * st.session_state['congestion_ema'])
+    return min(max_wait, random.uniform(base, max(base, prev_wait * 3)))
+
+def call_gemini_api(client, model_name, prompt, status, max_retries=5):
+    """Gemini API 스트리밍 호출 (429/503 재시도 포함, 최근 6턴 히스토리 유지, 재시도 안내는 status 자리에 표시)"""
+    chat = get_chat(client, model_name)
+    wait_time = 0
     
     for attempt in range(max_retries):
+        chunks = []
         try:
-            # 세션 생성 및 메시지 전송
-            chat = client.chats.create(model=model_name)
-            response = chat.send_message(full_prompt)
-            return response.text
+            # 응답 조각이 도착하는 대로 전달
+            for text in iterate_async(stream_gemini(chat, prompt)):
+                if not chunks:
+                    status.empty()  # 응답이 시작되면 재시도 안내 제거
+                chunks.append(text)
+                yield text
+            update_congestion(0)
+            if not chunks:
+                # 안전 필터 차단 등으로 텍스트 없이 끝난 경우
+                yield "죄송합니다. 이번 메시지에는 답변을 드리지 못했습니다. 표현을 조금 바꿔 다시 말씀해 주시겠어요?"
+                return
+            # 정상 응답만 다음 턴의 API 히스토리에 포함 (오류·빈 응답 제외)
+            st.session_state['contents'].extend([
+                types.Content(role="user", parts=[types.Part(text=prompt)]),
+                types.Content(role="model", parts=[types.Part(text="".join(chunks))]),
+            ])
+            return
             
         except APIError as e:
-            error_msg = str(e)
+            # 응답이 일부 전달된 뒤의 오류는 재시도하지 않음 (중복 출력 방지)
+            if chunks:
+                yield f"\n\n(응답 중 오류가 발생했습니다: {e})"
+                return
             # 429 (Rate Limit) 또는 503 (Service Unavailable) 오류 재시도
-            if ('429' in error_msg or '503' in error_msg or 'UNAVAILABLE' in error_msg) and attempt < max_retries - 1:
-                wait_time = min(2 ** attempt, 10)  # 최대 10초 대기 (지수 백오프)
-                st.warning(f"서버 일시적 오류 발생. {wait_time}초 후 재시도 중... ({(attempt + 1)}/{max_retries})")
+            if e.code in RETRYABLE_STATUS_CODES and attempt < max_retries - 1:
+                update_congestion(1)
+                retry_after = get_retry_after(e)
+                if retry_after is not None and retry_after > RETRY_MAX_DELAY:
+                    # 허용 시간 전에 재시도하면 429만 반복되므로 바로 안내하고 중단
+                    yield f"죄송합니다. 현재 요청이 많아 잠시 이용할 수 없습니다. 약 {math.ceil(retry_after)}초 후 다시 시도해 주세요."
+                    return
+                if retry_after is not None:
+                    wait_time = retry_after + random.uniform(0, 0.25)  # 서버 지정 대기 시간 그대로
+                else:
+                    wait_time = next_backoff(wait_time, RETRY_MAX_DELAY)
+                status.warning(f"서버 일시적 오류 발생. {wait_time:.1f}초 후 재시도 중... ({(attempt + 1)}/{max_retries})")
                 time.sleep(wait_time)
                 continue
             else:
-                st.error(f"API 오류: {error_msg}")
-                return f"죄송합니다. API 오류가 발생했습니다: {error_msg}"
+                yield f"죄송합니다. API 오류가 발생했습니다: {e}"
+                return
+        except asyncio.TimeoutError:
+            if chunks:
+                yield f"\n\n(응답이 {STREAM_CHUNK_TIMEOUT}초 이상 지연되어 중단되었습니다.)"
+                return
+            if attempt < max_retries - 1:
+                wait_time = next_backoff(wait_time, 5)
+                status.warning(f"응답이 {STREAM_CHUNK_TIMEOUT}초 이상 지연되고 있습니다. {wait_time:.1f}초 후 재시도 중... ({(attempt + 1)}/{max_retries})")
+                time.sleep(wait_time)
+                continue
+            else:
+                yield f"죄송합니다. 응답이 {STREAM_CHUNK_TIMEOUT}초 이상 지연되어 받을 수 없었습니다. 잠시 후 다시 시도해 주세요."
+                return
         except Exception as e:
+            if chunks:
+                yield f"\n\n(응답 중 오류가 발생했습니다: {e})"
+                return
             if attempt < max_retries - 1:
-                wait_time = min(2 ** attempt, 5)
-                st.warning(f"오류 발생. {wait_time}초 후 재시도 중... ({(attempt + 1)}/{max_retries})")
+                wait_time = next_backoff(wait_time, 5)
+                status.warning(f"오류 발생. {wait_time:.1f}초 후 재시도 중... ({(attempt + 1)}/{max_retries})")
                 time.sleep(wait_time)
                 continue
             else:
-                st.error(f"예기치 않은 오류: {e}")
-                return f"죄송합니다. 오류가 발생했습니다: {str(e)}"
+                yield f"죄송합니다. 오류가 발생했습니다: {str(e)}"
+                return
     
-    return "죄송합니다. 여러 번 시도했지만 응답을 받을 수 없었습니다. 잠시 후 다시 시도해 주세요."
+    yield "죄송합니다. 여러 번 시도했지만 응답을 받을 수 없었습니다. 잠시 후 다시 시도해 주세요."
 
 # --- UI 정의 ---
 st.set_page_config(page_title="심리상담 AI 챗봇", layout="centered")
@@ -109,89 +252,92 @@ if not api_key:
         st.stop()
 
 # 클라이언트 초기화
-client = initialize_client(api_key)
-if not client:
+try:
+    client = initialize_client(api_key)
+except Exception as e:
+    st.error(f"클라이언트 초기화 오류: {e}")
     st.stop()
 
-# 2. 사이드바 설정
-with st.sidebar:
-    st.header("설정 및 도구")
-    
-    # 모델 선택
+# 2. 사이드바 설정 (모델 변경·로그 다운로드 시 대화 히스토리를 다시 그리지 않도록 fragment로 분리)
+@st.fragment
+def sidebar_panel():
+    """모델 선택 및 로그 다운로드"""
+    # 모델 선택 (선택 즉시 이 fragment가 다시 실행되어 표시도 함께 갱신)
     selected_model = st.selectbox(
         "사용 모델 선택",
         MODEL_OPTIONS,
-        index=0  # gemini-2.0-flash 기본 선택
+        index=DEFAULT_MODEL_IDX,
+        key='selected_model'
     )
-    
-    # 대화 정보
-    st.subheader("대화 정보")
     st.markdown(f"**모델:** `{selected_model}`")
-    st.markdown(f"**세션 ID:** `{st.session_state['session_id']}`")
-    st.markdown(f"**대화 턴 수:** `{len(st.session_state['history']) // 2}`")
     
     # 로그 다운로드
     if st.button("💾 로그 다운로드 (CSV)"):
         if st.session_state['csv_log']:
-            df = pd.DataFrame(st.session_state['csv_log'])
-            csv_buffer = io.StringIO()
-            df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
+            trimmed = st.session_state['csv_log_total'] - len(st.session_state['csv_log'])
+            if trimmed > 0:
+                st.caption(f"메모리 제한으로 가장 오래된 로그 {trimmed}행은 파일에서 제외되었습니다.")
             st.download_button(
                 label="CSV 파일 다운로드",
-                data=csv_buffer.getvalue(),
+                data=build_csv_log(),
                 file_name=f"counseling_log_{st.session_state['session_id']}.csv",
                 mime="text/csv"
             )
         else:
             st.info("다운로드할 로그가 없습니다.")
+
+with st.sidebar:
+    st.header("설정 및 도구")
+    sidebar_panel()
     
     # 대화 초기화
-    if st.button("🔄 대화 초기화", type="primary"):
-        reset_conversation()
+    st.button("🔄 대화 초기화", type="primary", on_click=reset_conversation)
     
     st.markdown("---")
     st.warning("⚠️ 본 챗봇은 AI 상담이며, 심각한 심리적 불편은 반드시 전문가와 상담해야 합니다.")
 
-# 3. 대화 히스토리 표시
-for message in st.session_state['history']:
-    if 'role' in message and 'text' in message:
-        with st.chat_message(message["role"], avatar="🤖" if message["role"] == "model" else "🙂"):
-            st.markdown(message["text"])
-
-# 4. 사용자 입력 처리
-if user_prompt := st.chat_input("당신의 고민을 편안하게 털어놓아주세요..."):
-    # 사용자 메시지 표시
-    with st.chat_message("user", avatar="🙂"):
-        st.markdown(user_prompt)
+# 3. 대화 화면 (입력 시 사이드바·클라이언트 초기화 없이 이 영역만 재실행)
+@st.fragment
+def chat_panel(client):
+    """대화 정보·히스토리 표시 및 사용자 입력 처리"""
+    selected_model = st.session_state['selected_model']
+    # 대화 정보 (사이드바는 이 fragment에서 갱신할 수 없으므로 여기에 표시, 입력 처리 후 채움)
+    conversation_info = st.empty()
     
-    # AI 응답 생성
-    with st.spinner("전문적인 상담 답변을 생각하는 중입니다..."):
-        model_response = call_gemini_api(client, selected_model, user_prompt)
+    for role_id, text in st.session_state['history']:
+        role = ROLE_NAMES[role_id]
+        with st.chat_message(role, avatar=AVATARS[role]):
+            st.markdown(text)
     
-    # AI 응답 표시
-    with st.chat_message("model", avatar="🤖"):
-        st.markdown(model_response)
+    # 사용자 입력 처리
+    if user_prompt := st.chat_input("당신의 고민을 편안하게 털어놓아주세요..."):
+        # 사용자 메시지 표시
+        with st.chat_message("user", avatar=AVATARS["user"]):
+            st.markdown(user_prompt)
+        
+        # AI 응답 생성 및 표시 (스트리밍)
+        with st.chat_message("model", avatar=AVATARS["model"]):
+            status = st.empty()  # 재시도 안내 등 일시적 알림 자리
+            model_response = st.write_stream(call_gemini_api(client, selected_model, user_prompt, status))
+            status.empty()
+        
+        # 히스토리 저장
+        st.session_state['history'].extend([(USER, user_prompt), (MODEL, model_response)])
+        
+        # CSV 로그 기록
+        base_row = {
+            'session_id': st.session_state['session_id'],
+            'model': selected_model,
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        append_csv_log([
+            {**base_row, 'role': 'user', 'message': user_prompt},
+            {**base_row, 'role': 'model', 'message': model_response},
+        ])
     
-    # 히스토리 저장
-    st.session_state['history'].append({"role": "user", "text": user_prompt})
-    st.session_state['history'].append({"role": "model", "text": model_response})
-    
-    # CSV 로그 기록
-    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-    st.session_state['csv_log'].append({
-        'session_id': st.session_state['session_id'],
-        'model': selected_model,
-        'timestamp': timestamp,
-        'role': 'user',
-        'message': user_prompt
-    })
-    st.session_state['csv_log'].append({
-        'session_id': st.session_state['session_id'],
-        'model': selected_model,
-        'timestamp': timestamp,
-        'role': 'model',
-        'message': model_response
-    })
-    
-    # UI 업데이트
-    st.rerun()
+    conversation_info.caption(
+        f"**세션 ID:** `{st.session_state['session_id']}` · "
+        f"**대화 턴 수:** `{len(st.session_state['history']) // 2}`"
+    )
+
+chat_panel(client)